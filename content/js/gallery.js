@@ -0,0 +1,10 @@
+fetch("thumbnails.pack").then(function(rsp) {
+    return rsp.blob();
+}).then(function(pack) {
+    var vs = document.querySelectorAll("video[data-poster-offset]");
+    for (var v of vs) {
+        var offset = parseInt(v.dataset.posterOffset);
+        var length = parseInt(v.dataset.posterLength);
+        v.poster = URL.createObjectURL(pack.slice(offset, offset + length, v.dataset.posterType));
+    }
+});
@@ -318,15 +318,28 @@ let gallery title ?(preamble=None) ?(only_subtitle=true) fn =
     Lenient_iso8601.compare g1.last_modified g0.last_modified in
   let es = Utils.load_file fn |> Gallery_j.entries_of_string |> List.sort s in
 
+  (* thumbnails packed by gallery list --pack-thumbnails are served as one file
+     next to the pages, and sliced into posters by gallery.js *)
+  let packed = List.exists (fun (e: Gallery_j.entry) ->
+    match e.thumbnail with
+      Some t -> Option.is_some t.pack
+    | None -> false) es in
+  let pack_script = if packed then script @@ Utils.load_file @@ Path.js "gallery.js" else noop in
+
   let m (e: Gallery_j.entry) =
-    let poster = match e.thumbnail with
+    let poster, data = match e.thumbnail with
       Some t -> begin
-        match t.base64 with
-          Some b64 -> Some (sprintf "data:%s;base64,%s" t.content_type b64)
-        | None -> Some t.url
+        match t.base64, t.pack with
+          Some b64, _ -> Some (sprintf "data:%s;base64,%s" t.content_type b64), []
+        | None, Some p -> None, [
+            ("poster-offset", string_of_int p.offset);
+            ("poster-length", string_of_int p.length);
+            ("poster-type", t.content_type);
+          ]
+        | None, None -> Some t.url, []
       end
-      | None -> None in
-    if ContentType.is_video e.content_type then video ~id:(e.id) ~poster e.url
+      | None -> None, [] in
+    if ContentType.is_video e.content_type then video ~id:(e.id) ~poster ~data e.url
     else if ContentType.is_image e.content_type then
       img ~id:e.id ~embed:false e.url
     else failwith "content type not supported" in
@@ -347,6 +360,7 @@ let gallery title ?(preamble=None) ?(only_subtitle=true) fn =
     (Option.map (div ~cls:(Some "preamble")) preamble |> Option.to_list)
     (List.map g es)
     |> seq |> div ~cls:(Some "gallery")
+    |> (fun c -> seq [ c; pack_script ])
     |> pagemaker config title ~back:(Some "../index.html")
       ~additional_css:[ "gallery.css" ] in
 
@@ -372,11 +386,16 @@ let gallery title ?(preamble=None) ?(only_subtitle=true) fn =
         Some t -> p ~cls:(Some "description") @@ text t
       | None -> noop;
     ] |> div ~cls:(Some "entry") |> div ~cls:(Some "gallery")
+      |> (fun c -> seq [ c; pack_script ])
       |> pagemaker config title ~back:(Some "index.html") ~meta:[ og_video ]
       ~og_image:og_image ~og_type:og_type
       ~additional_css:[ "gallery.css" ] in
 
-  [ ("index.html", index ) ] @ List.map (fun (e: Gallery_j.entry) -> (sprintf "%s.html" e.id), p e) es
+  let pack =
+    if packed then [ ("thumbnails.pack", fun ~path:_ -> Utils.load_file (Filename.remove_extension fn ^ ".pack")) ]
+    else [] in
+
+  [ ("index.html", index ) ] @ pack @ List.map (fun (e: Gallery_j.entry) -> (sprintf "%s.html" e.id), p e) es
 
 let glenn = gallery (Page.Title "Glenn, Glenn, Glenn") (Path.meta "glenn.json")
 let silly = gallery (Title "Silly things") (Path.meta "silly.json")
@@ -62,10 +62,11 @@ let audio ?(id="") src = text @@
   sprintf "<audio%s controls preload=\"metadata\" class=\"sound\"><source src=\"%s\"/></audio>"
   (if id <> "" then sprintf " id=\"%s\"" id else "")
   (url_escape_string src |> html_escape_string)
-let video ?(id="") ?(poster=None) src = text @@
-  sprintf "<video%s%s controls preload=\"metadata\" class=\"video\"><source src=\"%s\"/></video>"
+let video ?(id="") ?(poster=None) ?(data=[]) src = text @@
+  sprintf "<video%s%s%s controls preload=\"metadata\" class=\"video\"><source src=\"%s\"/></video>"
   (if id <> "" then sprintf " id=\"%s\"" id else "")
   (match poster with Some p -> sprintf " poster=\"%s\"" p | None -> "")
+  (data >>| (fun (k, v) -> sprintf " data-%s=\"%s\"" k (html_escape_string v)) |> String.concat "")
   (url_escape_string src |> html_escape_string)
 let canvas id width height = text @@
   sprintf "<canvas id=\"%s\" width=\"%d\" height=\"%d\" />" id width height
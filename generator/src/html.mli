@@ -37,7 +37,10 @@ val div :
 val span : ?cls:string -> ('a -> string) -> 'a -> string
 
 val audio : ?id:string -> Camomile.UTF8.t -> 'a t
-val video : ?id:string -> ?poster:string option -> Camomile.UTF8.t -> 'a t
+val video :
+  ?id:string ->
+  ?poster:string option ->
+  ?data:(string * string) list -> Camomile.UTF8.t -> 'a t
 val canvas : string -> int -> int -> 'a t
 
 val a : Camomile.UTF8.t -> ('a -> string) -> 'a -> string
@@ -24,6 +24,9 @@ def main(event, context):
         "AWS_LAMBDA_FUNCTION_ARN": context.invoked_function_arn,
     }
 
+    # outlives the workdir, so warm invocations can reuse the tasks' S3 cache
+    env_ext.setdefault("TASKS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wwwo-cache"))
+
     if env("TARGET"):
         args += [ "-u", env("TARGET") ]
 
@@ -1,13 +1,18 @@
 PROJECTS_SPEC ?=
+# kept between runs, so that gallery list only re-renders what changed since
+GALLERY_PREVIOUS ?=
 TASKS_EXE_PREFIX ?= wwwo-
 
 META =
 
 META += sounds.json sounds.sessions.json sounds.demo.json sounds.practice.json
 META += git-activity.json
-META += twitch.rootmos2.json
 META += resume.json
 
+TWITCH_LOGINS = rootmos2
+TWITCH = $(TWITCH_LOGINS:%=twitch.%.json)
+META += $(TWITCH)
+
 META += glenn.json silly.json clips.json
 
 ifneq ($(PROJECTS_SPEC),)
@@ -26,8 +31,8 @@ sounds.json:
 sounds.%.json:
 	$(TASKS_EXE_PREFIX)sounds --prefix="$*" --output="$@"
 
-twitch.%.json:
-	$(TASKS_EXE_PREFIX)twitch "$*" --output="$@"
+$(TWITCH) &:
+	$(TASKS_EXE_PREFIX)twitch $(TWITCH_LOGINS) --output="twitch.{login}.json"
 
 git-activity.json:
 	$(TASKS_EXE_PREFIX)git-activity --days=30 \
@@ -42,11 +47,17 @@ resume.json:
 	$(TASKS_EXE_PREFIX)resume --output="$@"
 
 %.json:
-	$(TASKS_EXE_PREFIX)gallery list --generate-thumbnails --embed-thumbnails rootmos-static "$*" --output="$@"
+	$(TASKS_EXE_PREFIX)gallery list --generate-thumbnails --pack-thumbnails="$*.pack" \
+		$(if $(GALLERY_PREVIOUS),--previous="$(GALLERY_PREVIOUS)/$@") \
+		rootmos-static "$*" --output="$@"
+ifneq ($(GALLERY_PREVIOUS),)
+	@mkdir -p "$(GALLERY_PREVIOUS)"
+	cp "$@" "$@.manifest" "$(GALLERY_PREVIOUS)/"
+endif
 
 projects/%/gallery.json:
 	@mkdir -p "projects/$*"
-	$(TASKS_EXE_PREFIX)project gallery "$*" rootmos-static --output="projects/$*/gallery.json"
+	$(TASKS_EXE_PREFIX)project gallery "$*" rootmos-static --pack-thumbnails="projects/$*/gallery.pack" --output="projects/$*/gallery.json"
 
 projects/%/preamble.md:
 	@mkdir -p "projects/$*"
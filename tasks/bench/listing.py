@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#
+# Count the LIST pages fetched when listing a gallery prefix or the top level
+# of a bucket: the whole bucket filtered client-side (as before) versus
+# common.Listing's server-side Prefix/Delimiter, against moto's S3 stand-in.
+#
+#   pip install moto && python bench/listing.py
+
+import argparse
+import os
+import sys
+
+import boto3
+from moto import mock_aws
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from tasks.common import Listing
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark S3 listings against moto")
+    parser.add_argument("--other", metavar="N", type=int, default=2400, help="keys outside the listed prefixes")
+    parser.add_argument("--gallery", metavar="N", type=int, default=100, help="keys under the gallery prefix")
+    parser.add_argument("--top", metavar="N", type=int, default=25, help="keys at the top level")
+    return parser.parse_args()
+
+def before(bucket, keep):
+    pages, n = 0, 0
+    for page in bucket.objects.all().pages():
+        pages += 1
+        n += sum(1 for o in page if keep(o.key))
+    return pages, n
+
+def after(bucket, **kwargs):
+    l = Listing(bucket, **kwargs)
+    n = sum(1 for _ in l)
+    return l.pages, n
+
+def main():
+    args = parse_args()
+
+    with mock_aws():
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        bucket = s3.create_bucket(Bucket="bench")
+
+        keys = [ f"other/{i:05d}.json" for i in range(args.other) ]
+        keys += [ f"silly/{i:05d}.mp4" for i in range(args.gallery) ]
+        keys += [ f"{i:05d}.json" for i in range(args.top) ]
+        for k in keys:
+            bucket.put_object(Key=k, Body=b"")
+        print(f"{len(keys)} keys")
+
+        cases = [
+            ("silly/", lambda k: k.startswith("silly/"), { "prefix": "silly/" }),
+            ("top level", lambda k: "/" not in k, { "delimiter": "/" }),
+        ]
+        for what, keep, kwargs in cases:
+            p0, n0 = before(bucket, keep)
+            p1, n1 = after(bucket, **kwargs)
+            assert n0 == n1, (n0, n1)
+            print(f"{what}: {n1} objects, LIST pages: {p0} before, {p1} after")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import threading
+
+import botocore
+
+from .util import env
+
+import logging
+logger = logging.getLogger(__name__)
+
+def default_root():
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return env("CACHE_DIR", os.path.join(root, "wwwo"))
+
+default_max_size = int(env("CACHE_SIZE", 256 * 1024 * 1024))
+
+# intended for content-addressed keys (e.g. the gallery's thumbnails/{id}.jpg), so an
+# entry whose ETag matches the bucket listing is served without any request at all
+class Cache:
+    def __init__(self, root=None, max_size=None):
+        self.root = root or default_root()
+        self.max_size = default_max_size if max_size is None else max_size
+        self.lock = threading.Lock()
+
+        self.sizes = {}
+        for d, _, fns in os.walk(self.root):
+            for fn in fns:
+                if not fn.endswith(".etag"):
+                    p = os.path.join(d, fn)
+                    try:
+                        self.sizes[p] = os.path.getsize(p)
+                    except FileNotFoundError:
+                        pass
+
+    def path(self, obj):
+        return os.path.join(self.root, obj.bucket_name, obj.key)
+
+    def lookup(self, obj):
+        p = self.path(obj)
+        try:
+            with open(p + ".etag", "r") as f:
+                etag = f.read()
+            with open(p, "rb") as f:
+                data = f.read()
+            os.utime(p)
+        except FileNotFoundError:
+            return None, None
+        return etag, data
+
+    def get(self, obj, etag=None):
+        cached_etag, data = self.lookup(obj)
+
+        if cached_etag is not None:
+            if cached_etag == etag:
+                return data
+
+            if etag is None:
+                try:
+                    rsp = obj.get(IfNoneMatch=cached_etag)
+                except botocore.exceptions.ClientError as e:
+                    if e.response["Error"]["Code"] != "304":
+                        raise
+                    return data
+                return self.put(obj, rsp["ETag"], rsp["Body"].read())
+
+        rsp = obj.get()
+        return self.put(obj, rsp["ETag"], rsp["Body"].read())
+
+    def put(self, obj, etag, data):
+        p = self.path(obj)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+
+        for fn, mode, x in [ (p, "wb", data), (p + ".etag", "w", etag) ]:
+            with tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(p), delete=False) as f:
+                f.write(x)
+            os.replace(f.name, fn)
+
+        with self.lock:
+            self.sizes[p] = len(data)
+            self.evict()
+
+        return data
+
+    def evict(self):
+        total = sum(self.sizes.values())
+        if total <= self.max_size:
+            return
+
+        mtimes = {}
+        for p in list(self.sizes):
+            try:
+                mtimes[p] = os.stat(p).st_mtime
+            except FileNotFoundError:
+                # evicted by another process sharing the cache directory
+                total -= self.sizes.pop(p)
+
+        for p in sorted(mtimes, key=mtimes.get):
+            if total <= self.max_size:
+                break
+            logger.debug(f"evicting: {p}")
+            for fn in [ p, p + ".etag" ]:
+                try:
+                    os.remove(fn)
+                except FileNotFoundError:
+                    pass
+            total -= self.sizes.pop(p)
@@ -1,13 +1,37 @@
+import os
 import sys
 
 from contextlib import contextmanager
 
 import boto3
 
+import logging
+logger = logging.getLogger(__name__)
+
 def fetch_secret(arn):
     sm = boto3.client(service_name="secretsmanager", region_name=arn.split(":")[3])
     return sm.get_secret_value(SecretId=arn)["SecretString"]
 
+class Listing:
+    def __init__(self, bucket, prefix=None, delimiter=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.delimiter = delimiter
+        self.pages = 0
+
+    def __iter__(self):
+        kwargs = {}
+        if self.prefix:
+            kwargs["Prefix"] = self.prefix
+        if self.delimiter:
+            kwargs["Delimiter"] = self.delimiter
+
+        for page in self.bucket.objects.filter(**kwargs).pages():
+            self.pages += 1
+            yield from page
+
+        logger.debug(f"listed s3://{self.bucket.name}/{self.prefix or ''}: {self.pages} page(s)")
+
 @contextmanager
 def output(fn, mode="w"):
     if fn is None:
@@ -16,8 +40,15 @@ def output(fn, mode="w"):
         else:
             yield sys.stdout
     else:
-        f = open(fn, mode)
+        # write next to fn and rename into place, so that fn is never left truncated
+        d, base = os.path.split(os.path.abspath(fn))
+        tmp = os.path.join(d, f".{base}.{os.getpid()}.tmp")
+        f = open(tmp, mode)
         try:
             yield f
-        finally:
             f.close()
+            os.replace(tmp, fn)
+        except BaseException:
+            f.close()
+            os.remove(tmp)
+            raise
@@ -0,0 +1,133 @@
+import argparse
+import hashlib
+import os
+import pathlib
+import re
+import shutil
+import urllib.parse
+
+from .util import eprint
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fingerprint static assets referenced from HTML")
+
+    parser.add_argument("-o", "--output", metavar="FILE")
+    parser.add_argument("-x", "--exclude", metavar="PATH", action="append", default=[])
+
+    parser.add_argument("root", metavar="ROOT")
+
+    return parser.parse_args()
+
+# only subresources are fingerprinted: e.g. a linked download keeps its user-facing url
+tag = re.compile(r"<(link|script|img)\b[^>]*>", re.IGNORECASE)
+attribute = re.compile(r'''(\s([a-z-]+)=)(["'])([^"']*)\3''', re.IGNORECASE)
+
+def subresource(name, attrs):
+    if name in ["script", "img"]:
+        return "src"
+    elif name == "link" and set(attrs.get("rel", "").lower().split()) & { "stylesheet", "icon" }:
+        return "href"
+
+# a copy left behind by an earlier run: NAME.HASH.EXT next to NAME.EXT
+fingerprinted = re.compile(r"(.+)\.[0-9a-f]{10}(\.[^.]+)?")
+
+def fingerprinted_name(path):
+    with open(path, "rb") as f:
+        h = hashlib.file_digest(f, "sha256").hexdigest()[:10]
+    stem, ext = os.path.splitext(path.name)
+    if stem.endswith(f".{h}"):
+        return path.name
+    return f"{stem}.{h}{ext}"
+
+class Fingerprinter:
+    def __init__(self, root, exclude=None):
+        self.root = pathlib.Path(root).resolve()
+        self.exclude = set(exclude or [])
+        self.names = {}
+
+    def resolve(self, html, url):
+        u = urllib.parse.urlsplit(url)
+        if u.scheme or u.netloc or not u.path:
+            return None
+
+        path = urllib.parse.unquote(u.path)
+        if path.startswith("/"):
+            p = self.root / path.lstrip("/")
+        else:
+            p = html.parent / path
+        p = pathlib.Path(os.path.normpath(p))
+
+        if not p.is_relative_to(self.root) or not p.is_file() or p.suffix == ".html":
+            return None
+        if str(p.relative_to(self.root)) in self.exclude:
+            return None
+        return p
+
+    def fingerprint(self, p):
+        if p not in self.names:
+            name = fingerprinted_name(p)
+            if name != p.name:
+                # copy rather than rename, so that a regenerated page still finds the original
+                shutil.copy2(p, p.with_name(name))
+            self.names[p] = name
+        return self.names[p]
+
+    def rewrite(self, html):
+        with open(html, "r") as f:
+            s = f.read()
+
+        def replace(m):
+            attrs = { a.group(2).lower(): a.group(4) for a in attribute.finditer(m.group(0)) }
+            name = subresource(m.group(1).lower(), attrs)
+            if name is None:
+                return m.group(0)
+
+            def replace_url(a):
+                prefix, attr, quote, url = a.groups()
+                p = self.resolve(html, url) if attr.lower() == name else None
+                if p is None:
+                    return a.group(0)
+
+                u = urllib.parse.urlsplit(url)
+                d, _, _ = u.path.rpartition("/")
+                path = (d + "/" if "/" in u.path else "") + urllib.parse.quote(self.fingerprint(p))
+                return prefix + quote + urllib.parse.urlunsplit(u._replace(path=path)) + quote
+
+            return attribute.sub(replace_url, m.group(0))
+
+        t = tag.sub(replace, s)
+        if t != s:
+            with open(html, "w") as f:
+                f.write(t)
+
+    def prune(self):
+        current = set(p.with_name(name) for p, name in self.names.items())
+        pruned = []
+        for p in sorted(self.root.glob("**/*")):
+            m = fingerprinted.fullmatch(p.name)
+            if m is None or p in current or not p.is_file():
+                continue
+            # only copies of an existing original whose content matches their name
+            if p.with_name(m.group(1) + (m.group(2) or "")).is_file() and fingerprinted_name(p) == p.name:
+                p.unlink()
+                pruned.append(p)
+        return pruned
+
+def main():
+    args = parse_args()
+
+    fp = Fingerprinter(args.root, exclude=args.exclude)
+    for html in sorted(fp.root.glob("**/*.html")):
+        fp.rewrite(html)
+
+    for p, name in sorted(fp.names.items()):
+        eprint(f"{p.relative_to(fp.root)} -> {name}")
+
+    for p in fp.prune():
+        eprint(f"pruned: {p.relative_to(fp.root)}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            for p, name in sorted(fp.names.items()):
+                f.write(str(p.with_name(name).relative_to(fp.root)))
+                f.write("\n")
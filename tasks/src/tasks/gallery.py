@@ -1,22 +1,36 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import hashlib
 import json
 import subprocess
 import tempfile
+import threading
+import time
 import os
 import base64
 import mimetypes
+import shutil
 
 from urllib.parse import quote as urlencode
 
 from . import util
-from .common import output
+from .cache import Cache
+from .common import output, Listing
+from .util import eprint, env
 
 import boto3
 import botocore
-
-s3 = boto3.resource("s3")
-s3c = boto3.client("s3")
+import botocore.config
+import magic
+import PIL.Image
+import PIL.ImageOps
+
+# shared by the render workers, so size the connection pool accordingly
+s3config = botocore.config.Config(max_pool_connections=32)
+s3 = boto3.resource("s3", config=s3config)
+s3c = boto3.client("s3", config=s3config)
 default_region = "eu-central-1"
 
 def s3url(bucket, region, path):
@@ -34,53 +48,190 @@ def s3exists(obj):
             raise
     return False
 
+class Index:
+    def __init__(self, bucket, prefixes):
+        self.bucket = bucket
+        self.etags = {}
+        for prefix in prefixes:
+            for o in Listing(bucket, prefix=prefix):
+                self.etags[o.key] = o.e_tag
+
+    def __contains__(self, key):
+        return key in self.etags
+
+    def etag(self, key):
+        return self.etags.get(key)
+
+    def add(self, key, etag=None):
+        self.etags[key] = etag
+
+def read(obj, index=None, cache=None):
+    if cache is None:
+        return obj.get()["Body"].read()
+    etag = index.etag(obj.key) if index is not None else None
+    return cache.get(obj, etag=etag)
+
+def written(obj, etag, data, index=None, cache=None):
+    if index is not None:
+        index.add(obj.key, etag)
+    if cache is not None:
+        cache.put(obj, etag, data)
+
+thumbnailers = {}
+backends = {}
+
+def thumbnailer(name, *mimetypes):
+    def register(f):
+        backends[name] = f
+        for mt in mimetypes:
+            thumbnailers[mt] = f
+        return f
+    return register
+
+def find_thumbnailer(source):
+    mt = magic.from_file(source, mime=True)
+    return thumbnailers.get(mt) or thumbnailers.get(mt.split("/")[0]) or backends["ffmpeg"]
+
+def ffmpeg(*args):
+    cmdline = [ "ffmpeg", *args, "-loglevel", "quiet" ]
+    with Thumbnail.ffmpeg_slots:
+        subprocess.check_call(cmdline)
+
+def ffmpeg_scale(size):
+    return f"scale='min({size},iw)':'min({size},ih)':force_original_aspect_ratio=decrease"
+
+@thumbnailer("ffmpeg")
+def thumbnail_ffmpeg(source, output, size, frame=1):
+    ffmpeg("-i", source,
+        "-vf", f"select=eq(n\\,{frame}),{ffmpeg_scale(size)}",
+        "-frames:v", "1", "-update", "1",
+        "-y", output)
+
+@thumbnailer("video", "video")
+def thumbnail_video(source, output, size):
+    # seeking on the input side only decodes from the closest preceding keyframe
+    ffmpeg("-ss", str(Thumbnail.seek), "-i", source,
+        "-vf", ffmpeg_scale(size),
+        "-frames:v", "1", "-update", "1",
+        "-y", output)
+
+    if not os.path.exists(output):
+        # e.g. a clip shorter than the seek
+        thumbnail_ffmpeg(source, output, size)
+
+@thumbnailer("image", "image/jpeg", "image/png", "image/webp", "image/bmp", "image/tiff")
+def thumbnail_image(source, output, size):
+    with PIL.Image.open(source) as im:
+        # lets the JPEG decoder scale down while decoding instead of decoding the full image
+        im.draft("RGB", (size, size))
+        im = PIL.ImageOps.exif_transpose(im)
+        im.thumbnail((size, size))
+        im.convert("RGB").save(output, "JPEG", quality=85)
+
 class Thumbnail:
     bucket = s3.Bucket("rootmos-static")
     bucket_region = default_region
 
-    def __init__(self, id):
+    # try to produce video thumbnails from only the first bytes of the source (0 disables)
+    partial_size = int(env("THUMBNAIL_PARTIAL_SIZE", 8 * 1024 * 1024))
+
+    # longest side of generated thumbnails
+    size = int(env("THUMBNAIL_SIZE", 640))
+
+    # where in a video to grab its thumbnail (in seconds)
+    seek = float(env("THUMBNAIL_SEEK", 0.1))
+
+    # bounds the concurrent ffmpeg processes, while downloads and uploads overlap freely
+    ffmpeg_slots = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+    @classmethod
+    def set_ffmpeg_jobs(cls, n):
+        cls.ffmpeg_slots = threading.BoundedSemaphore(n)
+
+    def __init__(self, id, index=None, cache=None):
         self.id = id
-        self._obj = self.bucket.Object(f"thumbnails/{self.id}.jpg")
+        self.index = index
+        self.cache = cache
+        self.key = f"thumbnails/{self.id}.jpg"
+        self._obj = self.bucket.Object(self.key)
         self.url = s3url(bucket=self._obj.bucket_name, region=self.__class__.bucket_region, path=self._obj.key)
 
     @property
     def exists(self):
+        if self.index is not None:
+            return self._obj.key in self.index
         return s3exists(self._obj)
 
     @staticmethod
-    def generate(source, output, frame=1):
-        cmdline = [ "ffmpeg" ]
-        cmdline += [ "-i", source ]
-        cmdline += [ "-vf", f"select=eq(n\\,{frame})" ]
-        cmdline += [ "-frames:v", "1", "-update", "1" ]
-        cmdline += [ "-y", output ]
-        cmdline += [ "-loglevel", "quiet" ]
-        subprocess.check_call(cmdline)
+    def generate(source, output, backend=None, size=None):
+        f = backends[backend] if backend else find_thumbnailer(source)
+        f(source, output, size=size or Thumbnail.size)
+
+    def read(self):
+        return read(self._obj, index=self.index, cache=self.cache)
 
     @property
     def base64(self):
-        return str(base64.b64encode(self._obj.get()["Body"].read()), "UTF-8")
+        return str(base64.b64encode(self.read()), "UTF-8")
 
     @property
     def content_type(self):
         return "image/jpeg"
 
-    def upload(self, source):
+    def render(self, source):
         with tempfile.TemporaryDirectory() as tmp:
             output = os.path.join(tmp, "thumb.jpg")
             self.__class__.generate(source, output)
-            self._obj.upload_file(output, ExtraArgs={
-                "ACL": "public-read",
-                "ContentType": self.content_type
-            })
+            with open(output, "rb") as f:
+                return f.read()
+
+    def put(self, data):
+        rsp = self._obj.put(Body=data, ACL="public-read", ContentType=self.content_type)
+        written(self._obj, rsp["ETag"], data, index=self.index, cache=self.cache)
+
+    def upload(self, source):
+        self.put(self.render(source))
 
-    def ensure(self, obj):
-        if not self.exists:
+    def render_partial(self, obj, src):
+        rsp = obj.get(Range=f"bytes=0-{self.partial_size - 1}")
+        with open(src, "wb") as f:
+            shutil.copyfileobj(rsp["Body"], f)
+        n = os.path.getsize(src)
+
+        try:
+            return self.render(src), n
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            # e.g. an mp4 with its moov atom at the end of the file
+            eprint(f"unable to thumbnail {obj.key} from its first {n} bytes: falling back to a full download")
+            return None, n
+
+    def ensure(self, obj, source=None, rsp=None):
+        if not self.exists and source is not None:
+            self.put(self.render(source))
+        elif not self.exists:
+            # the caller's HEAD response, if any, spares loading obj for its attributes
+            if rsp is not None:
+                size, content_type = rsp["ContentLength"], rsp.get("ContentType")
+            else:
+                size, content_type = obj.content_length, obj.content_type
+
+            t0 = time.monotonic()
             with tempfile.TemporaryDirectory() as tmp:
                 _, ext = os.path.splitext(obj.key)
                 src = os.path.join(tmp, f"source.{ext}")
-                obj.download_file(src)
-                self.upload(src)
+
+                data, transferred = None, 0
+                partial = self.partial_size > 0 and size > self.partial_size
+                if partial and (content_type or "").startswith("video/"):
+                    data, transferred = self.render_partial(obj, src)
+
+                if data is None:
+                    obj.download_file(src)
+                    transferred += size
+                    data = self.render(src)
+
+                self.put(data)
+                eprint(f"thumbnail {self.key} for {obj.key}: transferred {transferred} bytes (size {size}) in {time.monotonic() - t0:.1f}s")
         return self
 
 class Meta:
@@ -89,51 +240,102 @@ class Meta:
 
     TEMPLATE = { "title": None, "description": None }
 
-    def __init__(self, id):
+    def __init__(self, id, index=None, cache=None):
         self.id = id
-        self._obj = self.bucket.Object(f"meta/{self.id}.json")
+        self.index = index
+        self.cache = cache
+        self.key = f"meta/{self.id}.json"
+        self._obj = self.bucket.Object(self.key)
 
     @property
     def exists(self):
+        if self.index is not None:
+            return self._obj.key in self.index
         return s3exists(self._obj)
 
     def load(self):
-        if self.exists:
-            return json.loads(self._obj.get()["Body"].read())
-        else:
+        if self.index is not None and not self.exists:
             return Meta.TEMPLATE
 
+        try:
+            return json.loads(read(self._obj, index=self.index, cache=self.cache))
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+        return Meta.TEMPLATE
+
     def edit(self):
         m = util.edit(self.load())
-        self._obj.put(Body=json.dumps(m).encode("UTF-8"), ACL="private")
+        data = json.dumps(m).encode("UTF-8")
+        rsp = self._obj.put(Body=data, ACL="private")
+        written(self._obj, rsp["ETag"], data, index=self.index, cache=self.cache)
         return m
 
+class Pack:
+    def __init__(self, f, index=None, cache=None):
+        self.f = f
+        self.index = index
+        self.cache = cache
+
+        self.offset = 0
+        self.refs = {}
+        self.staged = {}
+
+    def stage(self, id_, data):
+        self.staged[id_] = data
+
+    # called in output order, so the pack's layout doesn't depend on which render finished first
+    def commit(self, item):
+        id_ = item["id"]
+        data = self.staged.pop(id_, None)
+        if id_ not in self.refs:
+            if data is None:
+                data = Thumbnail(id_, index=self.index, cache=self.cache).read()
+            self.f.write(data)
+            self.refs[id_] = { "offset": self.offset, "length": len(data) }
+            self.offset += len(data)
+        item["thumbnail"]["pack"] = self.refs[id_]
+        return item
+
+def build_index():
+    return Index(Thumbnail.bucket, prefixes=["thumbnails/", "meta/"])
+
 def b64_to_hex(s):
     return str(base64.b16encode(base64.b64decode(s)), "UTF-8").lower()
 
-def id_from_obj(obj):
-    rsp = s3c.head_object(Bucket=obj.bucket_name, Key=obj.key, ChecksumMode="ENABLED")
-    if "ChecksumSHA256" in rsp:
+def head(obj):
+    return s3c.head_object(Bucket=obj.bucket_name, Key=obj.key, ChecksumMode="ENABLED")
+
+def id_from_obj(obj, rsp=None):
+    rsp = rsp or head(obj)
+    # multipart uploads only carry a checksum of their parts' checksums (suffixed with -N)
+    if "sha256" in rsp.get("Metadata", {}):
+        return rsp["Metadata"]["sha256"][:7]
+    elif "ChecksumSHA256" in rsp and "-" not in rsp["ChecksumSHA256"]:
         return b64_to_hex(rsp["ChecksumSHA256"])[:7]
     elif "ChecksumSHA1" in rsp:
         return b64_to_hex(rsp["ChecksumSHA1"])[:7]
     else:
         return hashlib.sha1(url(obj).encode("UTF-8")).hexdigest()[:7]
 
-def render(o, generate_thumbnails=None, embed_thumbnails=False):
+def render(o, generate_thumbnails=None, embed_thumbnails=False, index=None, cache=None, pack=None):
     obj = o.Object()
-    id_ = id_from_obj(obj)
+    rsp = head(obj)
+    id_ = id_from_obj(obj, rsp=rsp)
 
-    thumbnail = Thumbnail(id_)
+    thumbnail = Thumbnail(id_, index=index, cache=cache)
     if generate_thumbnails:
-        thumbnail = thumbnail.ensure(obj)
+        thumbnail = thumbnail.ensure(obj, rsp=rsp)
 
-    m = Meta(id_).load()
+    m = Meta(id_, index=index, cache=cache).load()
+
+    if pack is not None:
+        pack.stage(id_, thumbnail.read())
 
     return {
         "id": id_,
         "url": url(o),
-        "content_type": obj.content_type,
+        "content_type": rsp.get("ContentType"),
         "last_modified": o.last_modified.isoformat(),
         "thumbnail": {
             "url": thumbnail.url,
@@ -143,13 +345,145 @@ def render(o, generate_thumbnails=None, embed_thumbnails=False):
         **m
     }
 
+def render_iter(os, jobs=1, **kwargs):
+    def go(o):
+        try:
+            return render(o, **kwargs)
+        except Exception as e:
+            raise RuntimeError(f"unable to render: {o.bucket_name}/{o.key}") from e
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # only keep a bounded number of rendered items waiting to be consumed
+        window = collections.deque()
+
+        def pop():
+            while True:
+                pending = []
+                for f in window:
+                    if not f.done():
+                        pending.append(f)
+                    elif f.exception() is not None:
+                        # fail fast: drop whatever is still queued
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise f.exception()
+
+                if window[0].done():
+                    return window.popleft().result()
+
+                concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        for o in os:
+            window.append(executor.submit(go, o))
+            if len(window) >= 2 * jobs:
+                yield pop()
+
+        while window:
+            yield pop()
+
+def fingerprint(o, id_, index):
+    return {
+        "id": id_,
+        "url": url(o),
+        "etag": o.e_tag,
+        "last_modified": o.last_modified.isoformat(),
+        "thumbnail": index.etag(Thumbnail(id_).key),
+        "meta": index.etag(Meta(id_).key),
+    }
+
+def manifest_path(fn):
+    return f"{fn}.manifest"
+
+def iter_items(f, chunk_size=64 * 1024):
+    # one item at a time from either of dump_items' formats, so that a previous
+    # output full of embedded thumbnails is never held in memory all at once
+    decoder = json.JSONDecoder()
+    buf = ""
+    while True:
+        s = f.read(chunk_size)
+        buf += s
+        while True:
+            buf = buf.lstrip(" \t\r\n[,]")
+            if not buf:
+                break
+            try:
+                item, n = decoder.raw_decode(buf)
+            except json.JSONDecodeError:
+                if not s:
+                    raise
+                break
+            yield item
+            buf = buf[n:]
+        if not s:
+            return
+
+def dump_items(xs, f, ndjson=False):
+    if ndjson:
+        for x in xs:
+            f.write(json.dumps(x))
+            f.write("\n")
+        return
+
+    # byte for byte what json.dumps(list(xs)) would produce
+    f.write("[")
+    for i, x in enumerate(xs):
+        if i > 0:
+            f.write(", ")
+        f.write(json.dumps(x))
+    f.write("]")
+
+def no_previous():
+    return {}, iter([])
+
+# only the manifest is loaded: the items themselves are streamed, paired with the
+# manifest's keys since they were written in the same order
+def load_previous(fn, options):
+    try:
+        with open(manifest_path(fn), "r") as f:
+            manifest = json.load(f)
+        f = open(fn, "r")
+    except FileNotFoundError:
+        return no_previous()
+
+    if manifest["options"] != options:
+        f.close()
+        return no_previous()
+
+    def items():
+        with f:
+            yield from zip(manifest["objects"].keys(), iter_items(f))
+
+    return manifest["objects"], items()
+
+def render_incremental(os, previous, index, manifest, **kwargs):
+    fps, items = previous
+    os = list(os)
+
+    reused = set(o.key for o in os if o.key in fps and fingerprint(o, fps[o.key]["id"], index) == fps[o.key])
+    if fps:
+        eprint(f"reusing {len(reused)} of {len(os)} previously rendered items")
+
+    fresh = render_iter([ o for o in os if o.key not in reused ], index=index, **kwargs)
+    for o in os:
+        if o.key in reused:
+            # both listings are in key order, so the previous items are only ever scanned forward
+            item = next((i for k, i in items if k == o.key), None)
+            if item is None:
+                raise RuntimeError(f"previously rendered item not found: {o.key}")
+        else:
+            item = next(fresh)
+        manifest[o.key] = fingerprint(o, item["id"], index)
+        yield item
+
 def objects(bucket, prefix=None):
-    bucket = s3.Bucket(bucket)
+    return Listing(s3.Bucket(bucket), prefix=prefix)
 
-    for o in bucket.objects.all():
-        if prefix and not o.key.startswith(prefix):
-            continue
-        yield o
+def add_cache_arguments(parser):
+    parser.add_argument("--cache-dir", metavar="DIR")
+    parser.add_argument("--no-cache", action="store_true")
+
+def cache_from_args(args):
+    if not args.no_cache:
+        return Cache(root=args.cache_dir)
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Grab metadata about files stored on s3")
@@ -159,82 +493,213 @@ def parse_args():
     list_cmd = subparsers.add_parser("list")
     list_cmd.add_argument("-o", "--output", metavar="OUTPUT")
     list_cmd.add_argument("-G", "--generate-thumbnails", action="store_true")
-    list_cmd.add_argument("-e", "--embed-thumbnails", action="store_true")
+    thumbnails = list_cmd.add_mutually_exclusive_group()
+    thumbnails.add_argument("-e", "--embed-thumbnails", action="store_true")
+    thumbnails.add_argument("-p", "--pack-thumbnails", metavar="PACK")
+    list_cmd.add_argument("-j", "--jobs", metavar="N", type=int, default=8)
+    list_cmd.add_argument("-P", "--previous", metavar="PREVIOUS")
+    list_cmd.add_argument("--ndjson", action="store_true")
+    list_cmd.add_argument("--ffmpeg-jobs", metavar="N", type=int)
+    add_cache_arguments(list_cmd)
     list_cmd.add_argument("bucket", metavar="BUCKET")
     list_cmd.add_argument("prefix", metavar="PREFIX", nargs="?")
 
     thumbnail_cmd = subparsers.add_parser("thumbnail")
+    thumbnail_cmd.add_argument("-b", "--backend", choices=sorted(backends))
+    thumbnail_cmd.add_argument("-s", "--size", metavar="PIXELS", type=int)
     thumbnail_cmd.add_argument("source", metavar="SOURCE")
     thumbnail_cmd.add_argument("output", metavar="OUTPUT")
 
     meta_cmd = subparsers.add_parser("meta")
     meta_cmd.add_argument("id", metavar="ID")
+    add_cache_arguments(meta_cmd)
 
     upload_cmd = subparsers.add_parser("upload")
     upload_cmd.add_argument("-e", "--edit", action="store_true")
     upload_cmd.add_argument("-f", "--force", action="store_true")
     upload_cmd.add_argument("-p", "--prefix", metavar="PREFIX")
+    upload_cmd.add_argument("-j", "--jobs", metavar="N", type=int, default=8)
+    upload_cmd.add_argument("--part-jobs", metavar="N", type=int, default=4)
+    add_cache_arguments(upload_cmd)
     upload_cmd.add_argument("bucket", metavar="BUCKET")
-    upload_cmd.add_argument("file", metavar="FILE")
+    upload_cmd.add_argument("files", metavar="FILE", nargs="+")
 
     return parser.parse_args()
 
 def do_list(args):
-    os = []
-    for o in objects(args.bucket, prefix=args.prefix):
-        os.append(render(o,
+    if args.ffmpeg_jobs:
+        Thumbnail.set_ffmpeg_jobs(args.ffmpeg_jobs)
+
+    options = {
+        "generate_thumbnails": args.generate_thumbnails,
+        "embed_thumbnails": args.embed_thumbnails,
+        "pack_thumbnails": args.pack_thumbnails is not None,
+    }
+
+    previous = no_previous()
+    if args.previous is not None:
+        previous = load_previous(args.previous, options)
+
+    index = build_index()
+    cache = cache_from_args(args)
+
+    with contextlib.ExitStack() as stack:
+        pack = None
+        if args.pack_thumbnails is not None:
+            pack = Pack(stack.enter_context(output(args.pack_thumbnails, mode="wb")), index=index, cache=cache)
+
+        manifest = {}
+        os = render_incremental(objects(args.bucket, prefix=args.prefix),
+            previous=previous,
+            index=index,
+            manifest=manifest,
+            jobs=args.jobs,
+            cache=cache,
+            pack=pack,
             generate_thumbnails=args.generate_thumbnails,
             embed_thumbnails=args.embed_thumbnails,
-        ))
+        )
+        if pack is not None:
+            os = map(pack.commit, os)
+
+        with output(args.output) as f:
+            dump_items(os, f, ndjson=args.ndjson)
 
-    with output(args.output) as f:
-        f.write(json.dumps(os))
+    if args.output is not None:
+        with output(manifest_path(args.output)) as f:
+            f.write(json.dumps({ "options": options, "objects": manifest }))
 
 def do_thumbnail(args):
-    Thumbnail.generate(source=args.source, output=args.output)
+    t0 = time.monotonic()
+    Thumbnail.generate(source=args.source, output=args.output, backend=args.backend, size=args.size)
+    eprint(f"{args.source} -> {args.output}: {time.monotonic() - t0:.3f}s")
 
 def do_meta(args):
-    Meta(args.id).edit()
+    Meta(args.id, cache=cache_from_args(args)).edit()
 
-def do_upload(args):
-    with open(args.file, "rb") as f:
-        sha256 = hashlib.file_digest(f, "SHA256")
-        sha256_b64 = str(base64.b64encode(sha256.digest()), "UTF-8")
+multipart_threshold = 64 * 1024 * 1024
+part_size = 16 * 1024 * 1024
 
-    if args.prefix is None:
-        key = os.path.basename(args.file)
-    else:
-        key = f"{args.prefix}/{os.path.basename(args.file)}"
+def b64(digest):
+    return str(base64.b64encode(digest), "UTF-8")
 
-    skip_upload = False
-    if not args.force:
-        try:
-            obj = s3c.head_object(Bucket=args.bucket, Key=key, ChecksumMode="ENABLED")
-            if obj.get("ChecksumSHA256") == sha256_b64:
-                skip_upload = True
-        except botocore.exceptions.ClientError as e:
-            if e.response["Error"]["Code"] != "404":
-                raise
+def hash_file(fn):
+    # one pass for both the whole file's and the would-be multipart upload's part checksums
+    sha256 = hashlib.sha256()
+    parts = []
+    with open(fn, "rb") as f:
+        while chunk := f.read(part_size):
+            sha256.update(chunk)
+            parts.append(hashlib.sha256(chunk).digest())
+    return sha256, parts
 
-    if not skip_upload:
-        mt, _ = mimetypes.guess_type(args.file)
+def remote_sha256(bucket, key):
+    try:
+        rsp = s3c.head_object(Bucket=bucket, Key=key, ChecksumMode="ENABLED")
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] != "404":
+            raise
+        return None
+
+    if "sha256" in rsp.get("Metadata", {}):
+        return rsp["Metadata"]["sha256"]
+    elif "ChecksumSHA256" in rsp and "-" not in rsp["ChecksumSHA256"]:
+        return b64_to_hex(rsp["ChecksumSHA256"])
+
+def upload_multipart(bucket, key, fn, sha256, parts, content_type, part_jobs):
+    upload_id = s3c.create_multipart_upload(Bucket=bucket, Key=key,
+        ContentType = content_type,
+        ChecksumAlgorithm = "SHA256",
+        Metadata = { "sha256": sha256.hexdigest() },
+        ACL = "public-read",
+    )["UploadId"]
+
+    def upload_part(i):
+        with open(fn, "rb") as f:
+            f.seek(i * part_size)
+            body = f.read(part_size)
+        rsp = s3c.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+            PartNumber = i + 1,
+            Body = body,
+            ChecksumSHA256 = b64(parts[i]),
+        )
+        return { "PartNumber": i + 1, "ETag": rsp["ETag"], "ChecksumSHA256": b64(parts[i]) }
 
-        with open(args.file, "rb") as f:
-            s3c.put_object(Bucket=args.bucket, Key=key,
-                Body = f,
-                ContentType = mt,
-                ChecksumSHA256 = sha256_b64,
-                ACL = "public-read",
-            )
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=part_jobs) as executor:
+            ps = list(executor.map(upload_part, range(len(parts))))
+        s3c.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload = { "Parts": ps },
+        )
+    except BaseException:
+        s3c.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+def upload(bucket, key, fn, force=False, part_jobs=4, index=None, cache=None):
+    sha256, parts = hash_file(fn)
+    # what find_thumbnailer goes by
+    detected = magic.from_file(fn, mime=True)
+
+    if force or remote_sha256(bucket, key) != sha256.hexdigest():
+        mt, _ = mimetypes.guess_type(fn)
+        mt = mt or detected
+
+        if len(parts) > 1 and os.path.getsize(fn) >= multipart_threshold:
+            upload_multipart(bucket, key, fn, sha256, parts, content_type=mt, part_jobs=part_jobs)
+        else:
+            with open(fn, "rb") as f:
+                s3c.put_object(Bucket=bucket, Key=key,
+                    Body = f,
+                    ContentType = mt,
+                    ChecksumSHA256 = b64(sha256.digest()),
+                    Metadata = { "sha256": sha256.hexdigest() },
+                    ACL = "public-read",
+                )
+
+    # the id is what id_from_obj would derive from the checksum, and the
+    # thumbnail is made from the local file instead of downloading it again
+    id_ = sha256.hexdigest()[:7]
+    if detected.split("/")[0] in ["image", "video"]:
+        Thumbnail(id_, index=index, cache=cache).ensure(s3.Object(bucket, key), source=fn)
+    else:
+        eprint(f"not thumbnailing {fn}: {detected}")
+    return id_
+
+def upload_sources(files, prefix=None):
+    for fn in files:
+        if os.path.isdir(fn):
+            for d, _, fns in sorted(os.walk(fn)):
+                for f in sorted(fns):
+                    p = os.path.join(d, f)
+                    yield p, os.path.relpath(p, start=fn)
+        else:
+            yield fn, os.path.basename(fn)
 
-    obj = s3.Object(args.bucket, key)
-    id_ = id_from_obj(obj)
-    Thumbnail(id_).ensure(obj)
+def do_upload(args):
+    cache = cache_from_args(args)
+
+    sources = []
+    for fn, rel in upload_sources(args.files):
+        key = rel if args.prefix is None else f"{args.prefix}/{rel}"
+        sources.append((fn, key))
+
+    # one listing instead of a HEAD per file to see which thumbnails already exist
+    index = build_index() if len(sources) > 1 else None
+
+    # every file worker may run its own pool of part uploads: --jobs times --part-jobs
+    # connections, which the defaults keep within s3config's pool
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        ids = list(executor.map(
+            lambda s: upload(args.bucket, s[1], s[0], force=args.force, part_jobs=args.part_jobs, index=index, cache=cache),
+            sources,
+        ))
 
-    print(id_)
+    for (_, key), id_ in zip(sources, ids):
+        print(id_ if len(sources) == 1 else f"{id_} {key}")
 
     if args.edit:
-        Meta(id_).edit()
+        for id_ in ids:
+            Meta(id_, index=index, cache=cache).edit()
 
 def main():
     args = parse_args()
@@ -1,14 +1,20 @@
 import argparse
-import collections
 import concurrent.futures
+import contextlib
 import datetime
 import json
 import os
+import re
+import subprocess
+import threading
+import time
 
 import github
 import pytz
 
+from .cache import default_root
 from .common import fetch_secret, output
+from .store import CommitStore, default_path
 from .util import eprint
 from . import sourcehut
 
@@ -19,39 +25,102 @@ def github_token_from_env():
         token = fetch_secret(arn)
     return token
 
-def walk_github_repo(repo, author_name, after):
-    visited = set()
-    found = set()
-    unvisited = collections.deque()
-
-    for branch in repo.get_branches():
-        unvisited.append(branch.commit)
-
-    while unvisited:
-        c = unvisited.pop()
-
-        if c in visited:
-            continue
-        visited.add(c)
-
-        if after and c.commit.author.date < after:
-            continue
-
-        if c.commit.author.name == author_name:
-            found.add(c)
+class RequestCounter:
+    def __init__(self, throttle=None):
+        self.n = 0
+        self.lock = threading.Lock()
+        self.throttle = throttle
+
+    def wrap(self, f):
+        def g(*args, **kwargs):
+            with self.lock:
+                self.n += 1
+            headers, data = f(*args, **kwargs)
+            if self.throttle is not None:
+                self.throttle.update(headers)
+            return headers, data
+        return g
+
+class Throttle:
+    def __init__(self, jobs, margin=100):
+        self.jobs = jobs
+        self.margin = margin
+
+        self.limit = jobs
+        self.active = 0
+        self.reset = None
+        self.cond = threading.Condition()
+
+    def update(self, headers):
+        headers = { k.lower(): v for k, v in headers.items() }
+        try:
+            remaining = int(headers["x-ratelimit-remaining"])
+        except (KeyError, ValueError):
+            return
+
+        with self.cond:
+            # scale down the number of repositories processed at once as the budget runs out
+            self.limit = max(1, min(self.jobs, remaining // self.margin))
+            self.reset = None
+            if remaining == 0:
+                try:
+                    self.reset = float(headers["x-ratelimit-reset"])
+                except (KeyError, ValueError):
+                    pass
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            reset = self.reset
+
+        try:
+            if reset is not None and reset > time.time():
+                eprint(f"rate limited: waiting {reset - time.time():.0f}s")
+                time.sleep(reset - time.time())
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+def walk_github_repo(repo, tips, after, seen=None):
+    seen = set() if seen is None else seen
+
+    # the listings already carry the author, so no commit is fetched individually;
+    # the author filter can't be pushed to the server since it only matches logins and emails
+    for tip in tips:
+        kwargs = { "sha": tip }
+        if after:
+            kwargs["since"] = after
+
+        # the listings are ordered by date, not topology, so a commit seen through another
+        # branch says nothing about the ones that follow: skip it and let since end the walk
+        for c in repo.get_commits(**kwargs):
+            if c.sha in seen:
+                continue
+            seen.add(c.sha)
 
-        for p in c.parents:
-            if p in visited:
+            if after and c.commit.author.date < after:
                 continue
-            unvisited.append(p)
 
-    return found
+            yield c
 
 def figure_out_user_timezone(user):
     for tz in pytz.all_timezones:
         if tz.endswith(user.location):
             return pytz.timezone(tz)
 
+def render_github_repo(r):
+    return {
+        "name": r.name,
+        "url": r.html_url,
+        "public": r.visibility == "public",
+    }
+
 def render_github_commit(r, c, tz=None):
     date = c.commit.author.date
     if tz:
@@ -61,28 +130,55 @@ def render_github_commit(r, c, tz=None):
         "title": c.commit.message.splitlines()[0],
         "url": c.html_url,
         "date": date.isoformat(timespec="seconds"),
-        "repo": {
-            "name": r.name,
-            "url": r.html_url,
-            "public": r.visibility == "public",
-        }
+        "repo": render_github_repo(r),
     }
 
-def fetch_from_github(author_name, after):
-    api = github.Github(login_or_token=github_token_from_env())
+def since_timestamp(after):
+    return after.timestamp() if after else 0
+
+def fetch_from_github(author_name, after, jobs=4, store=None):
+    store = store or CommitStore()
+    since = since_timestamp(after)
+
+    throttle = Throttle(jobs)
+    api = github.Github(login_or_token=github_token_from_env(), per_page=100, pool_size=jobs)
+    requests = RequestCounter(throttle)
+    api.requester.requestJsonAndCheck = requests.wrap(api.requester.requestJsonAndCheck)
+
     user = api.get_user()
     tz = figure_out_user_timezone(user)
 
-    commits = collections.deque()
-    for repo in user.get_repos():
-        if repo.owner.login != user.login:
-            eprint(f"skipping GitHub repo: {repo.name}")
-            continue
-        eprint(f"processing GitHub repo: {repo.name}")
-        for commit in walk_github_repo(repo, author_name, after):
-            commits.append(render_github_commit(repo, commit, tz=tz))
+    def go(repo):
+        with throttle.slot():
+            tips = { b.name: b.commit.sha for b in repo.get_branches() }
+            stored, known = store.state("github", repo.html_url, since)
+            moved = [ tip for b, tip in tips.items() if stored is None or stored.get(b) != tip ]
+            eprint(f"processing GitHub repo: {repo.name} ({len(moved)} of {len(tips)} branches moved)")
+
+            commits = [ (c.sha, c.commit.author.name, c.commit.author.date.timestamp(), render_github_commit(repo, c, tz=tz))
+                       for c in walk_github_repo(repo, moved, after, seen=set(known)) ]
+            store.update("github", repo.html_url, since, tips, commits)
+            return [ c | { "repo": render_github_repo(repo) } for c in store.window("github", repo.html_url, author_name, since) ]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        fs = []
+        for repo in user.get_repos():
+            if repo.owner.login != user.login:
+                eprint(f"skipping GitHub repo: {repo.name}")
+                continue
+            fs.append(executor.submit(go, repo))
+        commits = [ c for f in fs for c in f.result() ]
+
+    eprint(f"GitHub API requests: {requests.n}")
 
-    return list(commits)
+    return commits
+
+def render_sourcehut_repo(r):
+    return {
+        "name": r.name,
+        "url": r.url,
+        "public": r.visibility == "PUBLIC",
+    }
 
 def render_sourcehut_commit(c):
     return {
@@ -90,33 +186,108 @@ def render_sourcehut_commit(c):
         "title": c.title,
         "url": c.url,
         "date": c.author.time.isoformat(timespec="seconds"),
+        "repo": render_sourcehut_repo(c.repo),
+    }
+
+def fetch_from_sourcehut(author_name, after, jobs=4, store=None):
+    store = store or CommitStore()
+    since = since_timestamp(after)
+
+    throttle = Throttle(jobs)
+    api = sourcehut.API(token=sourcehut.token_from_env(), on_response=lambda rsp: throttle.update(rsp.headers))
+
+    def go(repo):
+        with throttle.slot():
+            refs = repo.refs()
+            refs = [ ref for ref in refs.values() if not (ref.name == "HEAD" and ref.target in refs) ]
+            stored, known = store.state("sourcehut", repo.url, since)
+            moved = [ ref for ref in refs if stored is None or stored.get(ref.name) != ref.target ]
+            eprint(f"processing sourcehut repo: {repo.name} ({len(moved)} of {len(refs)} refs moved)")
+
+            commits = [ (c.id, c.author.name, c.author.time.timestamp(), render_sourcehut_commit(c))
+                       for c in repo.logs(moved, after=after, known=known) ]
+            store.update("sourcehut", repo.url, since, { ref.name: ref.target for ref in refs }, commits)
+            return [ c | { "repo": render_sourcehut_repo(repo) } for c in store.window("sourcehut", repo.url, author_name, since) ]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        fs = [ executor.submit(go, repo) for repo in api.repositories() ]
+        # the same commit can be pushed to several repositories: the first one listed wins
+        commits = {}
+        for f in fs:
+            for c in f.result():
+                commits.setdefault(c["hash"], c)
+
+    eprint(f"sourcehut GraphQL requests: {api.requests}")
+
+    return list(commits.values())
+
+def web_url(url):
+    m = re.fullmatch(r"[^/@]+@([^:/]+):(.*)", url)
+    if m:
+        url = f"https://{m.group(1)}/{m.group(2)}"
+    return url.removesuffix("/").removesuffix(".git")
+
+def update_mirror(url, root):
+    path = os.path.join(root, re.sub(r"[^A-Za-z0-9._-]", "_", web_url(url)))
+    if os.path.exists(path):
+        subprocess.run(["git", "-C", path, "fetch", "--prune", "--quiet"], check=True)
+    else:
+        subprocess.run(["git", "clone", "--mirror", "--quiet", url, path], check=True)
+    return path
+
+def log_mirror(path, author_name, after):
+    cmdline = ["git", "-C", path, "log", "--exclude=refs/pull/*", "--all", "--format=%H%x00%aI%x00%an%x00%B%x1e"]
+    cmdline += ["--fixed-strings", f"--author={author_name}"]
+    if after:
+        cmdline.append(f"--since={after.isoformat()}")
+
+    p = subprocess.run(cmdline, check=True, capture_output=True, text=True)
+    for record in p.stdout.split("\x1e"):
+        record = record.lstrip("\n")
+        if not record:
+            continue
+
+        sha, date, name, message = record.split("\x00")
+        date = datetime.datetime.fromisoformat(date)
+        # --author also matches the email and --since compares the committer date
+        if name != author_name or (after and date < after):
+            continue
+
+        yield sha, date, message
+
+def render_mirror_commit(url, sha, date, message, public=True):
+    repo = web_url(url)
+    lines = message.splitlines()
+    return {
+        "hash": sha,
+        "title": lines[0] if lines else None,
+        "url": f"{repo}/commit/{sha}",
+        "date": date.isoformat(timespec="seconds"),
         "repo": {
-            "name": c.repo.name,
-            "url": c.repo.url,
-            "public": c.repo.visibility == "PUBLIC",
+            "name": os.path.basename(repo),
+            "url": repo,
+            "public": public,
         }
     }
 
-def fetch_from_sourcehut(author_name, after):
-    api = sourcehut.API(token=sourcehut.token_from_env())
-
-    commits = set()
-    for repo in api.repositories():
-        eprint(f"processing sourcehut repo: {repo.name}")
-        refs = repo.refs()
-        for _, ref in refs.items():
-            if ref.name == "HEAD" and ref.target in refs:
-                continue
-            for c in ref.log():
-                if after and c.author.time < after:
-                    break
+def fetch_from_mirrors(urls, author_name, after, root=None, jobs=4):
+    root = root or os.path.join(default_root(), "mirrors")
+    os.makedirs(root, exist_ok=True)
 
-                if c.author.name != author_name:
-                    continue
+    def go(url, public):
+        eprint(f"processing mirror: {url}")
+        path = update_mirror(url, root)
+        return [ render_mirror_commit(url, *c, public=public) for c in log_mirror(path, author_name, after) ]
 
-                commits.add(c)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        fs = [ executor.submit(go, url, public) for url, public in urls ]
+        # the same commit can be pushed to several repositories: the first one listed wins
+        commits = {}
+        for f in fs:
+            for c in f.result():
+                commits.setdefault(c["hash"], c)
 
-    return [ render_sourcehut_commit(c) for c in commits ]
+    return list(commits.values())
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Fetch recent GitHub activity")
@@ -130,6 +301,15 @@ def parse_args():
     parser.add_argument("--github", action="store_true")
     parser.add_argument("--sourcehut", action="store_true")
 
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=4)
+
+    parser.add_argument("-m", "--mirror", metavar="URL", action="append", default=[])
+    parser.add_argument("-M", "--private-mirror", metavar="URL", action="append", default=[])
+    parser.add_argument("--mirror-dir", metavar="DIR")
+
+    parser.add_argument("-s", "--store", metavar="FILE", default=default_path())
+    parser.add_argument("-S", "--no-store", action="store_true")
+
     return parser.parse_args()
 
 def main():
@@ -140,19 +320,25 @@ def main():
         after = datetime.datetime.now().astimezone() - datetime.timedelta(days=args.days)
 
     commits = []
+    store = CommitStore(None if args.no_store else args.store)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
         fs = set()
         if args.github:
-            fs.add(executor.submit(fetch_from_github, author_name=args.author_name, after=after))
+            fs.add(executor.submit(fetch_from_github, author_name=args.author_name, after=after, jobs=args.jobs, store=store))
 
         if args.sourcehut:
-            fs.add(executor.submit(fetch_from_sourcehut, author_name=args.author_name, after=after))
+            fs.add(executor.submit(fetch_from_sourcehut, author_name=args.author_name, after=after, jobs=args.jobs, store=store))
+
+        mirrors = [ (url, True) for url in args.mirror ] + [ (url, False) for url in args.private_mirror ]
+        if mirrors:
+            fs.add(executor.submit(fetch_from_mirrors, mirrors, author_name=args.author_name, after=after, root=args.mirror_dir, jobs=args.jobs))
 
         for f in concurrent.futures.as_completed(fs):
             commits += f.result()
 
-    commits.sort(key=lambda c: c["date"])
+    # break ties so that the output doesn't depend on which repository finished first
+    commits.sort(key=lambda c: (c["date"], c["repo"]["url"], c["hash"]))
 
     with output(args.output) as f:
         f.write(json.dumps(commits))
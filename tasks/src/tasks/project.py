@@ -1,5 +1,5 @@
 import argparse
-import json
+import contextlib
 import sys
 
 import boto3
@@ -16,6 +16,11 @@ def parse_args():
     gallery_cmd.add_argument("project")
     gallery_cmd.add_argument("bucket")
     gallery_cmd.add_argument("-o", "--output")
+    gallery_cmd.add_argument("-j", "--jobs", metavar="N", type=int, default=8)
+    gallery_cmd.add_argument("--ffmpeg-jobs", metavar="N", type=int)
+    gallery_cmd.add_argument("--ndjson", action="store_true")
+    gallery_cmd.add_argument("-p", "--pack-thumbnails", metavar="PACK")
+    tasks.gallery.add_cache_arguments(gallery_cmd)
 
     preamble_cmd = subparsers.add_parser("preamble")
     preamble_cmd.add_argument("project")
@@ -28,11 +33,28 @@ def main():
     args = parse_args()
 
     if args.cmd == "gallery":
-        os = []
-        for o in tasks.gallery.objects(args.bucket, prefix=f"projects/{args.project}/"):
-            os.append(tasks.gallery.render(o, generate_thumbnails=True, embed_thumbnails=True))
-        with output(args.output) as f:
-            f.write(json.dumps(os))
+        if args.ffmpeg_jobs:
+            tasks.gallery.Thumbnail.set_ffmpeg_jobs(args.ffmpeg_jobs)
+        index = tasks.gallery.build_index()
+        cache = tasks.gallery.cache_from_args(args)
+        with contextlib.ExitStack() as stack:
+            pack = None
+            if args.pack_thumbnails is not None:
+                pack = tasks.gallery.Pack(stack.enter_context(output(args.pack_thumbnails, mode="wb")), index=index, cache=cache)
+
+            os = tasks.gallery.render_iter(
+                tasks.gallery.objects(args.bucket, prefix=f"projects/{args.project}/"),
+                jobs=args.jobs,
+                generate_thumbnails=True, embed_thumbnails=pack is None,
+                index=index,
+                cache=cache,
+                pack=pack,
+            )
+            if pack is not None:
+                os = map(pack.commit, os)
+
+            with output(args.output) as f:
+                tasks.gallery.dump_items(os, f, ndjson=args.ndjson)
     elif args.cmd == "preamble":
         s3 = boto3.resource("s3")
         o = s3.Bucket(args.bucket).Object(f"{args.project}/latest/www/preamble.md")
@@ -1,7 +1,14 @@
 import argparse
-import requests
+import concurrent.futures
+import json
+import math
+import threading
 import time
 
+import requests
+import requests.adapters
+
+from .common import output
 from .util import eprint, env
 
 def parse_args():
@@ -10,21 +17,168 @@ def parse_args():
     parser.add_argument("--cache-purge-token", metavar="TOKEN", default=env("CACHE_PURGE_TOKEN"))
     parser.add_argument("--rate-limit", type=int, default=env("RATE_LIMIT", "2"))
 
+    parser.add_argument("--rate", metavar="RPS", type=float, default=env("RATE"))
+    parser.add_argument("--burst", metavar="N", type=int, default=env("BURST", "1"))
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=env("JOBS", "4"))
+    parser.add_argument("--retries", metavar="N", type=int, default=env("RETRIES", "5"))
+
+    parser.add_argument("-w", "--warm", action="store_true")
+    parser.add_argument("-r", "--report", metavar="FILE")
+
     parser.add_argument("base_url", metavar="BASE_URL")
     parser.add_argument("paths", metavar="PATH", nargs="*")
 
     return parser.parse_args()
 
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.t = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # e.g. --rate-limit 0: no limit
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+                self.t = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def session(jobs):
+    s = requests.Session()
+    a = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=jobs)
+    s.mount("http://", a)
+    s.mount("https://", a)
+    return s
+
+def retry_after(rsp, attempt, backoff=0.5, max_delay=60):
+    try:
+        delay = float(rsp.headers["Retry-After"])
+    except (KeyError, ValueError):
+        delay = backoff * 2**attempt
+    # don't let a misbehaving server park a worker for hours
+    return min(max(delay, 0), max_delay)
+
+def request(s, bucket, method, url, retries=5, **kwargs):
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        t0 = time.monotonic()
+        rsp = s.request(method, url, **kwargs)
+        latency = time.monotonic() - t0
+
+        if (rsp.status_code == 429 or rsp.status_code >= 500) and attempt < retries:
+            delay = retry_after(rsp, attempt)
+            eprint(f"  {url}: {rsp.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        rsp.raise_for_status()
+        return rsp, latency
+
+def purge(s, bucket, url, token, retries=5):
+    rsp, latency = request(s, bucket, "HEAD", url, retries=retries, headers={"X-Cache-Purge": token})
+    if rsp.headers.get("X-Cache-Status") != "BYPASS":
+        raise RuntimeError(f"unable to purge: {url}")
+    eprint(f"purged: {url} (ETag: {rsp.headers.get('ETag')}) ({latency:.3f}s)")
+    return latency
+
+accept_encoding = "br, gzip, deflate"
+
+def fetch(s, bucket, url, retries=5):
+    rsp, ttfb = request(s, bucket, "GET", url, retries=retries, stream=True, headers={"Accept-Encoding": accept_encoding})
+    t0 = time.monotonic()
+    with rsp:
+        n = len(rsp.raw.read(decode_content=False))
+    return {
+        "status": rsp.status_code,
+        "cache": rsp.headers.get("X-Cache-Status"),
+        "encoding": rsp.headers.get("Content-Encoding"),
+        "bytes": n,
+        "ttfb": ttfb,
+        "total": ttfb + time.monotonic() - t0,
+    }
+
+def warm(s, bucket, url, retries=5):
+    first = fetch(s, bucket, url, retries=retries)
+    second = fetch(s, bucket, url, retries=retries)
+    ok = first["cache"] in ["MISS", "EXPIRED"] and second["cache"] == "HIT"
+    eprint(f"warmed: {url} ({first['cache']} {first['total']:.3f}s -> {second['cache']} {second['total']:.3f}s)")
+    return { "url": url, "ok": ok, "miss": first, "hit": second }
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[max(0, math.ceil(p / 100 * len(xs)) - 1)]
+
+def percentiles(xs):
+    if not xs:
+        return None
+    return { f"p{p}": percentile(xs, p) for p in [50, 90, 99] } | { "max": max(xs) }
+
+def summarize(what, latencies, failed):
+    l = f"{what} {len(latencies)}, failed {len(failed)}"
+    if latencies:
+        ps = " ".join(f"{k}={v:.3f}s" for k, v in percentiles(latencies).items())
+        l += f", latency: {ps}"
+    eprint(l)
+
+def run(executor, f, xs, *args, **kwargs):
+    fs = { executor.submit(f, *args, x, **kwargs): x for x in xs }
+    rs, failed = {}, []
+    for g in concurrent.futures.as_completed(fs):
+        try:
+            rs[fs[g]] = g.result()
+        except Exception as e:
+            eprint(f"failed: {fs[g]}: {e}")
+            failed.append(fs[g])
+    return rs, failed
+
 def main():
     args = parse_args()
-    delay = args.rate_limit/2
 
-    for p in args.paths:
-        url = f"{args.base_url}/{p}"
-        eprint(f"purging: {url}")
-        rsp = requests.head(url, headers={"X-Cache-Purge": args.cache_purge_token})
-        rsp.raise_for_status()
-        if rsp.headers["X-Cache-Status"] != "BYPASS":
-            raise RuntimeError(f"unable to purge: {url}")
-        eprint(f"  ETag: {rsp.headers['ETag']}")
-        time.sleep(delay)
+    rate = args.rate
+    if rate is None and args.rate_limit:
+        rate = 2 / args.rate_limit
+    bucket = TokenBucket(rate=rate, burst=args.burst)
+    s = session(args.jobs)
+
+    urls = [ f"{args.base_url}/{p}" for p in args.paths ]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        purged, failed = run(executor, purge, urls, s, bucket, token=args.cache_purge_token, retries=args.retries)
+        summarize("purged", list(purged.values()), failed)
+
+        if args.warm:
+            warmed, cold = run(executor, warm, [ u for u in urls if u in purged ], s, bucket, retries=args.retries)
+            pages = [ warmed[u] for u in urls if u in warmed ]
+            cold += [ p["url"] for p in pages if not p["ok"] ]
+            summarize("warmed", [ p["miss"]["total"] for p in pages if p["ok"] ], cold)
+
+            if args.report is not None:
+                report = {
+                    "base_url": args.base_url,
+                    "purged": { "ok": len(purged), "failed": failed, "latency": percentiles(list(purged.values())) },
+                    "warmed": {
+                        "ok": len(pages) - len(cold), "cold": cold,
+                        "ttfb": percentiles([ p["miss"]["ttfb"] for p in pages ]),
+                        "total": percentiles([ p["miss"]["total"] for p in pages ]),
+                        "hit": percentiles([ p["hit"]["total"] for p in pages ]),
+                    },
+                    "pages": pages,
+                }
+                with output(args.report) as f:
+                    f.write(json.dumps(report, indent=2))
+
+    if failed:
+        raise RuntimeError(f"unable to purge {len(failed)} of {len(urls)} paths")
@@ -4,7 +4,7 @@ import argparse
 
 from concurrent.futures import ThreadPoolExecutor
 
-from .common import output
+from .common import output, Listing
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Grab metadata about sounds stored on s3")
@@ -19,11 +19,11 @@ def main():
 
     pool = ThreadPoolExecutor(8)
     bucket = s3.Bucket("rootmos-sounds")
-    os = filter(lambda o: o.key.endswith(".json"), bucket.objects.all())
     if args.prefix:
-        os = filter(lambda o: o.key.startswith(args.prefix), os)
+        os = Listing(bucket, prefix=args.prefix)
     else:
-        os = filter(lambda o: "/" not in o.key, os)
+        os = Listing(bucket, delimiter="/")
+    os = filter(lambda o: o.key.endswith(".json"), os)
     ss = pool.map(lambda o: json.loads(o.get()["Body"].read()), os)
     with output(args.output) as f:
         f.write(json.dumps(list(ss), separators=(',', ':')))
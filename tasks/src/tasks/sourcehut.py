@@ -1,5 +1,7 @@
 import os
 import datetime
+import threading
+import time
 
 import requests
 
@@ -35,8 +37,12 @@ def token_from_env():
 class API:
     BASE_URL = "https://git.sr.ht"
 
-    def __init__(self, token):
+    def __init__(self, token, on_response=None):
         self.token = token
+        self.on_response = on_response
+
+        self.requests = 0
+        self.lock = threading.Lock()
 
         self.session = requests.Session()
         self.session.headers.update({
@@ -45,10 +51,26 @@ class API:
             "Content-Type": "application/json",
         })
 
-    def graphql(self, query):
+    def graphql(self, query, retries=5, max_delay=60):
         # query = re.sub(r"\s+", " ", query)
         # print("submitting query: " + query)
-        rsp = self.session.post(f"{API.BASE_URL}/query", json={ "query": query })
+        for attempt in range(retries + 1):
+            with self.lock:
+                self.requests += 1
+            rsp = self.session.post(f"{API.BASE_URL}/query", json={ "query": query })
+            if self.on_response is not None:
+                self.on_response(rsp)
+            if rsp.status_code != 429:
+                break
+            if attempt == retries:
+                raise RuntimeError(f"rate limited: giving up after {retries} retries")
+
+            try:
+                delay = float(rsp.headers["Retry-After"])
+            except (KeyError, ValueError):
+                delay = 2**attempt
+            time.sleep(min(max(delay, 0), max_delay))
+
         if rsp.status_code == 422:
             j = rsp.json()
             if "errors" in j:
@@ -197,6 +219,61 @@ class Repository:
             cs.append(Commit(self, raw))
         return cs[0] if len(ids) == 1 else cs
 
+    def logs(self, refs, after=None, seen=None, known=None, batch=16):
+        seen = set() if seen is None else seen
+        known = set() if known is None else known
+
+        # the refs still being paginated, with their cursors
+        pending = [ (ref, "null") for ref in refs ]
+        while pending:
+            cont = []
+            for n in range(0, len(pending), batch):
+                chunk = pending[n:n+batch]
+
+                logs = "\n".join("""
+                    r%d: log(cursor: %s, from: "%s") {
+                        cursor
+                        results {
+                            id, message
+                            author { name, email, time }
+                            committer { name, email, time }
+                        }
+                    }""" % (i, cursor, ref.target) for i, (ref, cursor) in enumerate(chunk))
+
+                query = """{
+                    user(username: "%s") {
+                        repository(name: "%s") {%s
+                        }
+                    }
+                }""" % (self.owner.username, self.name, logs)
+
+                repo = self.api.graphql(query)["user"]["repository"]
+                if repo is None:
+                    return
+
+                for i, (ref, _) in enumerate(chunk):
+                    log = repo[f"r{i}"]
+                    for raw in log["results"]:
+                        c = Commit(self, raw)
+                        # already fetched by an earlier run, but commits after it may not have been
+                        if c.id in known:
+                            continue
+
+                        # the logs are ordered by date, not topology, so a commit reached through
+                        # another ref says nothing about the ones that follow: let after end the walk
+                        if c.id in seen:
+                            continue
+                        seen.add(c.id)
+
+                        if after and c.author.time < after:
+                            break
+
+                        yield c
+                    else:
+                        if log["cursor"]:
+                            cont.append((ref, '"' + log["cursor"] + '"'))
+            pending = cont
+
 class Ref:
     def __init__(self, repo, raw):
         self.api = repo.api
@@ -0,0 +1,70 @@
+import os
+import sqlite3
+import threading
+
+from .cache import default_root
+from .util import env
+
+def default_path():
+    return env("COMMIT_STORE", os.path.join(default_root(), "git-activity.sqlite"))
+
+# commits are stored for every author, and without their repository: it is rendered
+# as it is now when the window is read, so e.g. a change of visibility applies at once
+class CommitStore:
+    version = 2
+
+    def __init__(self, fn=None):
+        if fn is None:
+            fn = ":memory:"
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(fn)), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fn, check_same_thread=False)
+        with self.db:
+            if self.db.execute("PRAGMA user_version").fetchone()[0] != CommitStore.version:
+                self.db.executescript("DROP TABLE IF EXISTS repos; DROP TABLE IF EXISTS refs; DROP TABLE IF EXISTS commits;")
+                self.db.execute(f"PRAGMA user_version = {CommitStore.version}")
+
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS repos (
+                    forge TEXT, repo TEXT, since REAL,
+                    PRIMARY KEY (forge, repo)
+                );
+                CREATE TABLE IF NOT EXISTS refs (
+                    forge TEXT, repo TEXT, ref TEXT, tip TEXT,
+                    PRIMARY KEY (forge, repo, ref)
+                );
+                CREATE TABLE IF NOT EXISTS commits (
+                    forge TEXT, repo TEXT, sha TEXT, author TEXT, time REAL, title TEXT, url TEXT, date TEXT,
+                    PRIMARY KEY (forge, repo, sha)
+                );
+            """)
+
+    def state(self, forge, repo, since):
+        with self.lock:
+            row = self.db.execute("SELECT since FROM repos WHERE forge = ? AND repo = ?", (forge, repo)).fetchone()
+            if row is None or row[0] > since:
+                # never seen, or seen with a shorter window
+                return None, set()
+
+            tips = dict(self.db.execute("SELECT ref, tip FROM refs WHERE forge = ? AND repo = ?", (forge, repo)))
+            known = set(sha for sha, in self.db.execute("SELECT sha FROM commits WHERE forge = ? AND repo = ?", (forge, repo)))
+            return tips, known
+
+    def update(self, forge, repo, since, tips, commits):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO repos VALUES (?, ?, ?)", (forge, repo, since))
+
+            self.db.execute("DELETE FROM refs WHERE forge = ? AND repo = ?", (forge, repo))
+            self.db.executemany("INSERT INTO refs VALUES (?, ?, ?, ?)", [ (forge, repo, ref, tip) for ref, tip in tips.items() ])
+
+            self.db.executemany("INSERT OR REPLACE INTO commits VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [ (forge, repo, sha, author, time, c["title"], c["url"], c["date"]) for sha, author, time, c in commits ])
+            self.db.execute("DELETE FROM commits WHERE forge = ? AND repo = ? AND time < ?", (forge, repo, since))
+
+    def window(self, forge, repo, author, since):
+        with self.lock:
+            rows = self.db.execute("SELECT sha, title, url, date FROM commits WHERE forge = ? AND repo = ? AND author = ? AND time >= ? ORDER BY time DESC, sha",
+                (forge, repo, author, since))
+            return [ { "hash": sha, "title": title, "url": url, "date": date } for sha, title, url, date in rows ]
@@ -1,11 +1,18 @@
 import argparse
+import collections
+import concurrent.futures
 import json
 import os
 import re
 import requests
+import requests.adapters
 import base64
+import threading
+import time
 
+from .cache import default_root
 from .common import fetch_secret, output
+from .util import env
 
 def parse_duration(string):
     p = re.compile("([0-9]+)([dDhHmMsS])")
@@ -23,83 +30,211 @@ def parse_duration(string):
             secs += n * 60 * 60 * 24
     return secs
 
-def download_thumbnail(url_template, width, height):
-    url = url_template.replace("%{width}", str(width)).replace("%{height}", str(height))
-    r = requests.get(url)
+def download_thumbnail(url, session=requests, etag=None):
+    h = {} if etag is None else { "If-None-Match": etag }
+    r = session.get(url, headers=h)
+    if r.status_code == 304:
+        return etag, None
     r.raise_for_status()
-    return {
+    return r.headers.get("ETag"), {
         "mimetype": r.headers["Content-Type"],
         "base64": str(base64.b64encode(r.content), "UTF-8"),
     }
 
+class State:
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.used = set()
+
+        s = {}
+        if fn is not None:
+            try:
+                with open(fn, "r") as f:
+                    s = json.load(f)
+            except FileNotFoundError:
+                pass
+
+        self.token = s.get("token")
+        self.logins = s.get("logins", {})
+        self.users = s.get("users", {})
+        self.thumbnails = s.get("thumbnails", {})
+
+    def thumbnail(self, url):
+        with self.lock:
+            self.used.add(url)
+            return self.thumbnails.get(url)
+
+    def set_thumbnail(self, url, etag, thumbnail):
+        with self.lock:
+            self.thumbnails[url] = { "etag": etag, "thumbnail": thumbnail }
+
+    def save(self):
+        if self.fn is None:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.fn)), exist_ok=True)
+        with self.lock:
+            s = {
+                "token": self.token,
+                "logins": self.logins,
+                "users": self.users,
+                # drop thumbnails of vods that are gone
+                "thumbnails": { u: t for u, t in self.thumbnails.items() if u in self.used },
+            }
+        # holds the access token, so it must not be readable by anyone else
+        d, base = os.path.split(os.path.abspath(self.fn))
+        tmp = os.path.join(d, f".{base}.{os.getpid()}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(s))
+            os.replace(tmp, self.fn)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
 class Crawler:
     helix_url = "https://api.twitch.tv/helix"
     oauth2_url = "https://id.twitch.tv/oauth2"
 
-    def __init__(self, thumbnail_width, thumbnail_height):
+    def __init__(self, thumbnail_width, thumbnail_height, jobs=4, users=1, state=None, full=False):
         self.client_id = os.environ["TWITCH_CLIENT_ID"]
-        self.client_secret = fetch_secret(os.environ["TWITCH_CLIENT_SECRET_ARN"])
 
-        self._token = None
-        self._user_id = None
+        self.state = state or State()
+        self.full = full
+        self.lock = threading.Lock()
 
         self.thumbnail_width = thumbnail_width
         self.thumbnail_height = thumbnail_height
 
+        self.jobs = jobs
+        self.session = requests.Session()
+        # each concurrently crawled user gets its own pool of thumbnail downloads
+        a = requests.adapters.HTTPAdapter(pool_maxsize=users * (jobs + 1))
+        self.session.mount("https://", a)
+
     @property
     def token(self):
-        if self._token is None:
-            params = {
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-                "grant_type": "client_credentials",
-                "scope": "",
+        with self.lock:
+            t = self.state.token
+            if t is None or t["expires_at"] < time.time() + 60:
+                params = {
+                    "client_id": self.client_id,
+                    "client_secret": fetch_secret(os.environ["TWITCH_CLIENT_SECRET_ARN"]),
+                    "grant_type": "client_credentials",
+                    "scope": "",
+                }
+                r = self.session.post(Crawler.oauth2_url + "/token", params=params)
+                r.raise_for_status()
+                j = r.json()
+                t = { "access_token": j["access_token"], "expires_at": time.time() + j["expires_in"] }
+                self.state.token = t
+            return t["access_token"]
+
+    def get(self, path, params):
+        for retry in [True, False]:
+            token = self.token
+            h = {
+                "Client-ID": self.client_id,
+                "Authorization": f"Bearer {token}",
             }
-            r = requests.post(Crawler.oauth2_url + "/token", params=params)
+            r = self.session.get(Crawler.helix_url + path, params=params, headers=h)
+            if r.status_code == 401 and retry:
+                # revoked before its expiry
+                with self.lock:
+                    if self.state.token is not None and self.state.token["access_token"] == token:
+                        self.state.token = None
+                continue
             r.raise_for_status()
-            self._token = r.json()["access_token"]
-        return self._token
+            return r.json()
 
-    def vods(self, user_id, typ=None):
-        h = {
-            "Client-ID": self.client_id,
-            "Authorization": f"Bearer {self.token}",
-        }
-        p = { "user_id": user_id }
-        vs = []
+    def thumbnail(self, i):
+        url = i["thumbnail_url"].replace("%{width}", str(self.thumbnail_width)).replace("%{height}", str(self.thumbnail_height))
+
+        cached = self.state.thumbnail(url)
+        if cached is not None and not self.full:
+            return cached["thumbnail"]
+
+        etag, t = download_thumbnail(url, session=self.session, etag=cached and cached["etag"])
+        if t is None:
+            return cached["thumbnail"]
 
+        self.state.set_thumbnail(url, etag, t)
+        return t
+
+    def videos(self, user_id):
+        known = [] if self.full else self.state.users.get(user_id, {}).get("vods", [])
+        ids = { i["id"]: n for n, i in enumerate(known) }
+
+        p = { "user_id": user_id }
         while True:
-            r = requests.get(Crawler.helix_url + "/videos", params=p, headers=h)
-            r.raise_for_status()
-            j = r.json()
-            for i in j["data"]:
-                if typ is not None and typ != i["type"]:
-                    continue
+            j = self.get("/videos", p)
+            # fetched vods are always yielded fresh: e.g. one still processing changes its duration
+            yield from j["data"]
+
+            # newest first, so the vods beyond the last known one on this page are already known
+            reached = [ ids[i["id"]] for i in j["data"] if i["id"] in ids ]
+            if reached:
+                fetched = set(i["id"] for i in j["data"])
+                yield from (k for k in known[max(reached) + 1:] if k["id"] not in fetched)
+                return
+
+            if "cursor" not in j["pagination"]: break
+            p["after"] = j["pagination"]["cursor"]
 
-                yield {
+    def vods(self, user_id, typ=None):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            # thumbnails are downloaded while the next pages are fetched, but only
+            # a bounded number of vods are kept waiting to be consumed
+            window = collections.deque()
+
+            def pop():
+                i, f = window.popleft()
+                try:
+                    t = f.result()
+                except Exception:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+                return {
                     "video_id": i["id"],
                     "title": i["title"],
                     "url": i["url"],
                     "duration": float(parse_duration(i["duration"])),
                     "date": i["published_at"],
-                    "thumbnail": download_thumbnail(i["thumbnail_url"], self.thumbnail_width, self.thumbnail_height),
+                    "thumbnail": t,
                 }
 
-            if "cursor" not in j["pagination"]: break
-            p["after"] = j["pagination"]["cursor"]
+            seen = []
+            for i in self.videos(user_id):
+                seen.append(i)
+                if typ is not None and typ != i["type"]:
+                    continue
+
+                window.append((i, executor.submit(self.thumbnail, i)))
+                if len(window) >= 4 * self.jobs:
+                    yield pop()
+
+            while window:
+                yield pop()
 
-        return vs
+        with self.state.lock:
+            self.state.users[user_id] = { "vods": seen }
+
+    def user_ids(self, logins):
+        missing = [ l for l in logins if l not in self.state.logins ]
+        # /users accepts at most 100 logins per request
+        for n in range(0, len(missing), 100):
+            ls = missing[n:n+100]
+            us = { u["login"]: u["id"] for u in self.get("/users", { "login": ls })["data"] }
+            for l in ls:
+                if l.lower() not in us:
+                    raise RuntimeError(f"no such Twitch user: {l}")
+                self.state.logins[l] = us[l.lower()]
+        return { l: self.state.logins[l] for l in logins }
 
     def user_id(self, login):
-        h = {
-            "Client-ID": self.client_id,
-            "Authorization": f"Bearer {self.token}",
-        }
-        p = { "login": [login] }
-        r = requests.get(Crawler.helix_url + "/users", params=p, headers=h)
-        r.raise_for_status()
-        [u] = r.json()["data"]
-        return u["id"]
+        return self.user_ids([login])[login]
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Fetch metadata about Twitch vods")
@@ -111,16 +246,35 @@ def parse_args():
     parser.add_argument("--thumbnail-width", type=int, default=320)
     parser.add_argument("--thumbnail-height", type=int, default=180)
 
-    parser.add_argument("login")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=4)
+
+    parser.add_argument("-s", "--state", metavar="FILE", default=env("TWITCH_STATE", os.path.join(default_root(), "twitch.json")))
+    parser.add_argument("-S", "--no-state", action="store_true")
+    parser.add_argument("-F", "--full", action="store_true")
 
-    return parser.parse_args()
+    parser.add_argument("logins", metavar="login", nargs="+")
+
+    args = parser.parse_args()
+    if len(args.logins) > 1 and (args.output is None or "{login}" not in args.output):
+        parser.error("several logins require an --output containing {login}")
+    return args
 
 def main():
     args = parse_args()
 
-    c = Crawler(thumbnail_width=args.thumbnail_width, thumbnail_height=args.thumbnail_height)
+    state = State(None if args.no_state else args.state)
+    c = Crawler(thumbnail_width=args.thumbnail_width, thumbnail_height=args.thumbnail_height, jobs=args.jobs, users=len(args.logins), state=state, full=args.full)
+
+    user_ids = c.user_ids(args.logins)
+
+    def crawl(login):
+        vs = list(c.vods(user_ids[login], typ=args.type))
+        fn = None if args.output is None else args.output.format(login=login)
+        with output(fn) as f:
+            f.write(json.dumps(vs))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(args.logins)) as executor:
+        for f in [ executor.submit(crawl, l) for l in args.logins ]:
+            f.result()
 
-    user_id = c.user_id(args.login)
-    vs = list(c.vods(user_id, typ=args.type))
-    with output(args.output) as f:
-        f.write(json.dumps(vs))
+    state.save()
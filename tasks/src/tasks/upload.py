@@ -1,14 +1,30 @@
 import argparse
+import concurrent.futures
+import fnmatch
+import gzip
 import hashlib
+import io
+import itertools
+import json
 import os
 import pathlib
+import threading
+import time
 import urllib
 import mimetypes
 
 import boto3
+import botocore.config
+import botocore.exceptions
 
+from .common import Listing
 from .util import eprint
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Upload directory to s3")
 
@@ -16,6 +32,16 @@ def parse_args():
 
     parser.add_argument("-H", "--htmls")
 
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=8)
+
+    parser.add_argument("-s", "--sync", action="store_true")
+    parser.add_argument("-d", "--delete", action="store_true")
+    parser.add_argument("-c", "--changed", metavar="FILE")
+
+    parser.add_argument("-z", "--compress", choices=["gzip", "br"])
+    parser.add_argument("-C", "--cache-control", metavar="PATTERN=VALUE", action="append", default=[])
+    parser.add_argument("-I", "--immutable", metavar="FILE")
+
     parser.add_argument("root", metavar="ROOT")
     parser.add_argument("target", metavar="S3_URL")
 
@@ -26,44 +52,199 @@ def parse_s3_url(url):
     assert(p.scheme == "s3")
     return p.netloc, p.path.lstrip("/")
 
+def parse_cache_control(policy):
+    rules = []
+    for p in policy:
+        pattern, value = p.split("=", 1)
+        rules.append((pattern, value))
+    return rules
+
+def cache_control(rel, rules):
+    for pattern, value in rules:
+        if fnmatch.fnmatch(rel, pattern):
+            return value
+
+compressible_types = [
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+    "image/x-icon",
+]
+
+def compressible(mt):
+    return mt is not None and (mt.startswith("text/") or mt in compressible_types)
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    elif encoding == "gzip":
+        # mtime=0 keeps the output, and so its MD5 and the sync, deterministic
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    else:
+        raise NotImplementedError(encoding)
+
+def remote_etags(bucket, prefix):
+    # only what is below the target "directory", e.g. not prod-old/ when syncing to prod
+    prefix = os.path.join(prefix, "")
+    etags = {}
+    for o in Listing(bucket, prefix=prefix):
+        etags[o.key] = o.e_tag.strip('"')
+    return etags
+
+def unchanged(o, md5, etag):
+    if etag is None:
+        return False
+    elif "-" not in etag:
+        return etag == md5
+    else:
+        # multipart uploads' ETags are not MD5s of their content
+        return o.metadata.get("md5") == md5
+
+# what each object was last uploaded with, so that e.g. a new Cache-Control rule
+# re-uploads objects whose content hasn't changed
+manifest_name = ".upload-manifest.json"
+
+def headers_digest(extra):
+    return hashlib.sha256(json.dumps(extra, sort_keys=True).encode("UTF-8")).hexdigest()
+
+def load_manifest(o):
+    try:
+        return json.loads(o.get()["Body"].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+    return {}
+
+def delete(s3, bucket, keys):
+    keys = sorted(keys)
+    for i in range(0, len(keys), 1000):
+        rsp = s3.meta.client.delete_objects(Bucket=bucket, Delete={
+            "Objects": [ { "Key": k } for k in keys[i:i+1000] ],
+            "Quiet": True,
+        })
+        if rsp.get("Errors"):
+            raise RuntimeError("unable to delete objects", rsp["Errors"])
+
 def main():
     args = parse_args()
 
     mimetypes.init()
     mimetypes.add_type("image/x-icon", ".ico") # https://en.wikipedia.org/wiki/Favicon#Standardization
+    mimetypes.add_type("application/octet-stream", ".pack") # gallery thumbnails, see gallery list --pack-thumbnails
 
     bucket, prefix = parse_s3_url(args.target)
 
-    htmls = None
-    if args.htmls is not None:
-        htmls = open(args.htmls, "w")
+    encoding = args.compress
+    if encoding == "br" and brotli is None:
+        eprint("brotli module not available: falling back to gzip")
+        encoding = "gzip"
+
+    rules = parse_cache_control(args.cache_control)
+
+    if args.immutable is not None:
+        # fingerprinted assets (see wwwo-fingerprint): their content never changes under the same name
+        with open(args.immutable, "r") as f:
+            immutable = [ (l.strip(), "public, max-age=31536000, immutable") for l in f if l.strip() ]
+        rules = immutable + rules
+
+    s3 = boto3.resource('s3', config=botocore.config.Config(max_pool_connections=max(10, args.jobs)))
+
+    manifest_obj = s3.Object(bucket, os.path.join(prefix, manifest_name))
+    remote, manifest = None, {}
+    if args.sync or args.delete:
+        remote = remote_etags(s3.Bucket(bucket), prefix)
+        remote.pop(manifest_obj.key, None)
+        manifest = load_manifest(manifest_obj)
+
+    ps = sorted(p for p in pathlib.Path(args.root).glob("**/*") if not p.is_dir())
+    progress = itertools.count(1)
+    lock = threading.Lock()
+
+    def process(p):
+        t0 = time.monotonic()
 
-    s3 = boto3.resource('s3')
-    for p in pathlib.Path(args.root).glob("**/*"):
-        if p.is_dir():
-            continue
         rel = os.path.relpath(p, start=args.root)
         key = os.path.join(prefix, rel)
         o = s3.Object(bucket, key)
 
-        with open(p, "rb") as f:
-            md5 = hashlib.file_digest(f, "md5").hexdigest()
-
         (mt, _) = mimetypes.guess_type(p)
 
-        if htmls and mt.startswith("text/html"):
-            htmls.write(key)
-            htmls.write("\n")
+        extra = {
+            "ACL": "public-read",
+            "ContentType": mt,
+        }
+
+        cc = cache_control(rel, rules)
+        if cc is not None:
+            extra["CacheControl"] = cc
+
+        data, body = None, None
+        if encoding and compressible(mt):
+            with open(p, "rb") as f:
+                data = f.read()
+            body = compress(data, encoding)
+            # e.g. a tiny file grows by the gzip header: upload it as is
+            if len(body) >= len(data):
+                body = None
+
+        if body is not None:
+            extra["ContentEncoding"] = encoding
+            md5 = hashlib.md5(body).hexdigest()
+        elif data is not None:
+            md5 = hashlib.md5(data).hexdigest()
+        else:
+            with open(p, "rb") as f:
+                md5 = hashlib.file_digest(f, "md5").hexdigest()
+        extra["Metadata"] = { "md5": md5 }
+        digest = headers_digest(extra)
 
         l = f"{p} -> {o} ({mt}) (MD5:{md5})"
-        if args.dry_run:
-            eprint("DRYRUN: " + l)
+        if body is not None:
+            l += f" ({encoding}: {len(body)}/{os.path.getsize(p)} bytes)"
+        if remote is not None and manifest.get(key) == digest and unchanged(o, md5, remote.get(key)):
+            l = "UNCHANGED: " + l
+            changed = False
+        elif args.dry_run:
+            l = "DRYRUN: " + l
+            changed = True
         else:
-            eprint(l)
-            o.upload_file(p, ExtraArgs = {
-                "ACL": "public-read",
-                "ContentType": mt,
-            })
-
-    if htmls:
-        htmls.close()
+            if body is not None:
+                o.upload_fileobj(io.BytesIO(body), ExtraArgs=extra)
+            else:
+                o.upload_file(p, ExtraArgs=extra)
+            changed = True
+
+        with lock:
+            eprint(f"[{next(progress)}/{len(ps)}] {l} ({time.monotonic() - t0:.3f}s)")
+        return key, mt, changed, digest
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(process, ps))
+
+    changed = [ key for key, _, c, _ in results if c ]
+
+    uploaded = { key: digest for key, _, _, digest in results }
+    if not args.dry_run and uploaded != manifest:
+        manifest_obj.put(Body=json.dumps(uploaded).encode("UTF-8"), ContentType="application/json")
+
+    if args.delete:
+        orphans = sorted(remote.keys() - { key for key, _, _, _ in results })
+        for key in orphans:
+            eprint(("DRYRUN: " if args.dry_run else "") + f"delete: s3://{bucket}/{key}")
+        if not args.dry_run:
+            delete(s3, bucket, orphans)
+        changed += orphans
+
+    if args.htmls is not None:
+        with open(args.htmls, "w") as f:
+            for key, mt, _, _ in results:
+                if mt and mt.startswith("text/html"):
+                    f.write(key)
+                    f.write("\n")
+
+    if args.changed is not None:
+        with open(args.changed, "w") as f:
+            for key in changed:
+                f.write(key)
+                f.write("\n")